@@ -1,30 +1,48 @@
 import asyncio
+from copy import copy
 from dataclasses import dataclass
 from enum import Enum
 from pathlib import Path
 import logging
-from typing import Optional
+from typing import Dict, List, Optional, Tuple
 from collections import deque
-import subprocess as sub
+from itertools import islice
 import os
 import signal
+import stat
 import json
+import re
 import argparse
 from pprint import pformat
+from urllib.parse import quote
 
 from aiohttp.web_request import Request
 from aiohttp.web_response import Response
 from aiohttp.web_fileresponse import FileResponse
 
 import jinja2
-import aiohttp_jinja2
 import aiohttp.web as web
 
-logging.basicConfig(level=logging.DEBUG)
-logging.getLogger('').setLevel("DEBUG")
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+    WATCHED_EVENTS = (
+        inotify_flags.CREATE | inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO
+        | inotify_flags.DELETE | inotify_flags.MOVED_FROM | inotify_flags.DELETE_SELF | inotify_flags.MOVE_SELF
+    )
+except ImportError:
+    INotify = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO").upper())
 
 logger = logging.getLogger(__name__)
 
+_MEDIA_NAME_RE = re.compile(r'(?!\.\.?$)[^/\x00]{1,255}')
+
 
 class MemeStatus(Enum):
     NEW = 'NEW'
@@ -33,79 +51,148 @@ class MemeStatus(Enum):
     RETRACTED = 'RETRACTED'
 
 
-@dataclass(frozen=True)
 class Multimedia:
-    path: Path
-    status: MemeStatus
-    description: str = ""
+    __slots__ = ('path', 'status', 'description')
+
+    def __init__(self, path: Path, status: MemeStatus, description: str = ""):
+        self.path = path
+        self.status = status
+        self.description = description
+
+    def __repr__(self):
+        return f"{type(self).__name__}(path={self.path!r}, status={self.status!r}, description={self.description!r})"
 
 
 class Meme(Multimedia):
-    pass
+    __slots__ = ()
 
 
 class Commercial(Multimedia):
-    pass
+    __slots__ = ()
+
+
+@dataclass
+class DirectoryCache:
+    mtime_ns: Optional[int] = None
 
 
 class MultimediaQueue:
     
     BAD_STATUSES = [MemeStatus.PENDING, MemeStatus.RETRACTED]
+    SAVED_STATUSES = BAD_STATUSES + [MemeStatus.NEW]
+    MAX_HISTORY = 128
     
     def __init__(self, safe_file: str):
         self._media: dict[Path, Meme] = {}
-        self._media_queue: deque[Path] = deque()
-        self._displayed_media = []
+        self._active: deque[Path] = deque()
+        self._blocked: set[Path] = set()
+        self._saved_media: dict[Path, MemeStatus] = {}
+        self._displayed_media: deque[Meme] = deque(maxlen=self.MAX_HISTORY)
         self._save_file = safe_file
+        self._dirty = False
         try:
-            self._meme_info = json.load(open(self._save_file))
+            meme_info = self._read_save_file()
         except FileNotFoundError:
-            self._meme_info = {}
-        logger.debug(f"save_file = {pformat(self._meme_info)}")
+            meme_info = {}
+        self._status_map: dict[Path, MemeStatus] = {
+            Path(path): MemeStatus(status) for path, status in meme_info.items()
+        }
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("save_file = %s", pformat(self._status_map))
     
     def add_media(self, meme_path: Path, is_init=False):
-        info = self._meme_info
-        if meme_path not in self._media.keys():
-            meme_status = MemeStatus(info.get(str(meme_path), "NORMAL")) if is_init else MemeStatus.NEW
+        if meme_path not in self._media:
+            meme_status = self._status_map.get(meme_path, MemeStatus.NORMAL) if is_init else MemeStatus.NEW
             meme = Meme(meme_path, meme_status)
             self._media[meme_path] = meme
-            logger.debug(f"Adding {meme}")
-            self._media_queue.append(meme_path)
+            logger.debug("Adding %s", meme)
+            if meme_status in self.SAVED_STATUSES:
+                self._saved_media[meme_path] = meme_status
+                if not is_init:
+                    self._dirty = True
+            if meme_status in self.BAD_STATUSES:
+                self._blocked.add(meme_path)
+            else:
+                self._active.append(meme_path)
 
-    def dump_bad_media(self):
-        json.dump({
-           str(meme.path): meme.status.name for meme in self.media
-        }, open(self._save_file, 'w'))
+    def remove_media(self, meme_path: Path):
+        if self._media.pop(meme_path, None) is None:
+            return
+        logger.debug("Removing %s", meme_path)
+        self._blocked.discard(meme_path)
+        if self._saved_media.pop(meme_path, None) is not None:
+            self._dirty = True
+        try:
+            self._active.remove(meme_path)
+        except ValueError:
+            pass
+
+    def _read_save_file(self) -> Dict[str, str]:
+        if orjson is not None:
+            return orjson.loads(Path(self._save_file).read_bytes())
+        with open(self._save_file) as save_file:
+            return json.load(save_file)
+
+    def _write_save_file(self, meme_info: Dict[str, str]):
+        tmp_file = self._save_file + '.tmp'
+        if orjson is not None:
+            Path(tmp_file).write_bytes(orjson.dumps(meme_info))
+        else:
+            with open(tmp_file, 'w') as save_file:
+                json.dump(meme_info, save_file)
+        os.replace(tmp_file, self._save_file)
+
+    async def dump_bad_media(self):
+        if not self._dirty:
+            return
+        meme_info = {
+           str(meme_path): status.name for meme_path, status in self._saved_media.items()
+        }
+        await asyncio.get_running_loop().run_in_executor(None, self._write_save_file, meme_info)
+        self._dirty = False
 
     def _change_status(self, meme_path: Path, status: MemeStatus):
-        self._media[meme_path] = Meme(self._media[meme_path].path, status)
+        meme = self._media[meme_path]
+        if meme.status != status and (meme.status in self.SAVED_STATUSES or status in self.SAVED_STATUSES):
+            self._dirty = True
+        meme.status = status
+        if status in self.SAVED_STATUSES:
+            self._saved_media[meme_path] = status
+        else:
+            self._saved_media.pop(meme_path, None)
     
     def block_media(self, meme_path: Path):
         self._change_status(meme_path, MemeStatus.PENDING)
+        # Blocked paths stay in _active until next_media pops and drops them.
+        self._blocked.add(meme_path)
     
     def next_media(self) -> Optional[Meme]:
-        while True:
-            if not self._media_queue:
-                return None
-            meme_path = self._media_queue.pop()
-            if self._media[meme_path].status in self.BAD_STATUSES:
+        while self._active:
+            meme_path = self._active.pop()
+            if meme_path in self._blocked:
                 continue
             if not meme_path.is_file():
                 del self._media[meme_path]
                 continue
-            break
-        meme = self._media[meme_path]
-        self._change_status(meme_path, MemeStatus.NORMAL)
-        self._displayed_media.append(meme)
-        self._media_queue.appendleft(meme.path)
-        return meme
+            meme = self._media[meme_path]
+            if meme.status == MemeStatus.NEW:
+                # Statuses are updated in place, hand out a copy that still says NEW.
+                meme = copy(meme)
+            self._change_status(meme_path, MemeStatus.NORMAL)
+            self._displayed_media.append(meme)
+            self._active.appendleft(meme_path)
+            return meme
+        return None
     
     def get_last_media(self, cnt: int):
-        return self._displayed_media[-cnt:]
+        return list(islice(self._displayed_media, max(0, len(self._displayed_media) - cnt), None))
     
+    def __contains__(self, meme_path: Path) -> bool:
+        return meme_path in self._media
+
     @property
     def media(self):
-        return list(self._media.values())
+        return self._media.values()
 
 
 class MemeDisplay:
@@ -119,32 +206,48 @@ class MemeDisplay:
         args = ['feh', '--loadable', str(meme_path)]
         proc = await asyncio.create_subprocess_exec(*args)
         await proc.communicate()
-        print(f"LOADABLE RESULT: {proc.returncode}")
+        logger.debug("feh --loadable %s returned %s", meme_path, proc.returncode)
         return proc.returncode == 0
 
-    async def display_meme(self, meme: Meme):
-        print(f"{meme}")
+    @staticmethod
+    async def _wait(proc):
+        try:
+            await proc.wait()
+        except asyncio.CancelledError:
+            if proc.returncode is None:
+                proc.terminate()
+            raise
+
+    async def _run(self, *args, **kwargs):
+        proc = await asyncio.create_subprocess_exec(*args, **kwargs)
+        await self._wait(proc)
+
+    async def display_meme(self, meme: Optional[Meme]):
+        logger.debug("Displaying %s", meme)
+        if not meme:
+            return
         if self._feh_display is None:
             args = ['feh', f'{meme.path}', '--bg-max']
-            sub.run(args)
+            await self._run(*args, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
         elif self._is_loadable(meme.path):
             os.remove(self._pic_path)
             os.symlink(meme.path, self._pic_path)
             os.kill(self._feh_display, signal.SIGUSR1)
         if meme.status == MemeStatus.NEW:
             args = ["cvlc", "nowymem.wav", "--play-and-exit"]
-            proc = await asyncio.create_subprocess_exec(*args)
-            await proc.communicate()
+            await self._run(*args)
 
     async def display_commercial(self, commercial: Optional[Meme]):
-        print(f"{commercial}")
+        logger.debug("Displaying %s", commercial)
         if not commercial:
             return
         args = ["cvlc", "--video-wallpaper", "--play-and-exit", f"{commercial.path}"]
         proc = await asyncio.create_subprocess_exec(*args)
         self._current_commercial = proc
-        await proc.communicate()
-        self._current_commercial = None
+        try:
+            await self._wait(proc)
+        finally:
+            self._current_commercial = None
     
     async def kill_commercial(self):
         if self._current_commercial:
@@ -160,72 +263,196 @@ class MemeWatcher:
         self.directory = Path(directory)
         self.meme_queue = MultimediaQueue('meme_info')
         self.commercial_queue = MultimediaQueue('commercial_info') if commercial_directory else None
-        self._ensure_commercial = False
+        self._commercial_requested = asyncio.Event()
         self._meme_displayer = MemeDisplay(feh_pid, feh_pic)
         self._commercial_rate = commercial_rate
         self._commercial_directory = Path(commercial_directory) if commercial_directory else None
+        self._meme_cache = DirectoryCache()
+        self._commercial_cache = DirectoryCache()
+        self._watch_tasks: list[asyncio.Task] = []
+        self._polling = INotify is None
+        self._active_display: Optional[asyncio.Task] = None
+        self._since_commercial = 0
 
     async def kill_commercial(self):
         await self._meme_displayer.kill_commercial()
     
     def ask_for_commercial(self):
-        self._ensure_commercial = True
+        self._commercial_requested.set()
     
-    def update_commercials(self, is_init=False):
+    @staticmethod
+    def _scan(directory: Path, cache: DirectoryCache) -> List[Path]:
+        mtime_ns = os.stat(directory).st_mtime_ns
+        if mtime_ns == cache.mtime_ns:
+            return []
+        cache.mtime_ns = mtime_ns
+        with os.scandir(directory) as entries:
+            return [Path(entry.path) for entry in entries if entry.is_file()]
+
+    def _watched_directories(self) -> List[Tuple[MultimediaQueue, Path, DirectoryCache]]:
+        directories = [(self.meme_queue, self.directory, self._meme_cache)]
         if self._commercial_directory:
-            for commercial_path in self._commercial_directory.iterdir():
-                self.commercial_queue.add_media(commercial_path, is_init=is_init)
+            directories.append((self.commercial_queue, self._commercial_directory, self._commercial_cache))
+        return directories
+
+    def update_media(self):
+        for queue, directory, cache in self._watched_directories():
+            for media_path in self._scan(directory, cache):
+                queue.add_media(media_path)
+
+    async def load_media(self):
+        loop = asyncio.get_running_loop()
+        directories = self._watched_directories()
+        listings = await asyncio.gather(*(
+            loop.run_in_executor(None, self._scan, directory, cache) for _, directory, cache in directories
+        ))
+        for (queue, _, _), media_paths in zip(directories, listings):
+            for media_path in media_paths:
+                queue.add_media(media_path, is_init=True)
+
+    async def _watch_directory(self, queue: MultimediaQueue, directory: Path, cache: DirectoryCache, inotify):
+        loop = asyncio.get_running_loop()
+        readable = asyncio.Event()
+        loop.add_reader(inotify.fileno(), readable.set)
+        try:
+            while True:
+                await readable.wait()
+                readable.clear()
+                for event in inotify.read(timeout=0):
+                    media_path = directory / event.name
+                    if event.mask & inotify_flags.Q_OVERFLOW:
+                        logger.warning("inotify queue overflowed for %s, rescanning", directory)
+                        cache.mtime_ns = None
+                        for rescanned_path in self._scan(directory, cache):
+                            queue.add_media(rescanned_path)
+                    elif event.mask & (inotify_flags.IGNORED | inotify_flags.DELETE_SELF | inotify_flags.MOVE_SELF):
+                        logger.warning("Watched directory %s went away", directory)
+                        return
+                    elif event.mask & inotify_flags.ISDIR:
+                        continue
+                    elif event.mask & (inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO):
+                        queue.add_media(media_path)
+                    elif event.mask & inotify_flags.CREATE:
+                        # Regular files are added once fully written, but symlinks and
+                        # hard links never get CLOSE_WRITE.
+                        try:
+                            media_stat = os.lstat(media_path)
+                        except FileNotFoundError:
+                            continue
+                        if stat.S_ISLNK(media_stat.st_mode) or media_stat.st_nlink > 1:
+                            queue.add_media(media_path)
+                    elif event.mask & (inotify_flags.DELETE | inotify_flags.MOVED_FROM):
+                        queue.remove_media(media_path)
+        finally:
+            loop.remove_reader(inotify.fileno())
+            inotify.close()
+
+    def _fall_back_to_polling(self):
+        self._polling = True
+        for _, _, cache in self._watched_directories():
+            cache.mtime_ns = None
+
+    def _watch_done(self, task: asyncio.Task):
+        if task.cancelled():
+            return
+        logger.error("Directory watcher stopped, falling back to polling", exc_info=task.exception())
+        self._fall_back_to_polling()
+
+    def _start_watching(self, queue: MultimediaQueue, directory: Path, cache: DirectoryCache):
+        try:
+            inotify = INotify()
+            inotify.add_watch(directory, WATCHED_EVENTS)
+        except OSError:
+            logger.exception("Cannot watch %s, falling back to polling", directory)
+            self._fall_back_to_polling()
+            return
+        task = asyncio.create_task(self._watch_directory(queue, directory, cache, inotify))
+        task.add_done_callback(self._watch_done)
+        self._watch_tasks.append(task)
+
+    def _cancel_display(self):
+        if self._active_display and not self._active_display.done():
+            self._active_display.cancel()
+
+    @staticmethod
+    def _display_done(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Displaying meme failed", exc_info=task.exception())
 
     async def watch_memes(self):
         meme_display = self._meme_displayer
-        meme_cnt = 1
-        for meme_path in self.directory.iterdir():
-            self.meme_queue.add_media(meme_path, is_init=True)
-        self.update_commercials(is_init=True)
-        while True:
-            for meme_path in self.directory.iterdir():
-                self.meme_queue.add_media(meme_path)
-            self.update_commercials()
-            if self._commercial_directory and not (meme_cnt % self._commercial_rate):
-                await meme_display.display_commercial(self.commercial_queue.next_media())
-            if self._ensure_commercial:
-                self._ensure_commercial = False
-                meme_cnt = 0
-                await meme_display.display_commercial(self.commercial_queue.next_media())
-            else:
-                meme = self.meme_queue.next_media()
-                await meme_display.display_meme(meme)
-            meme_cnt += 1
-            await asyncio.sleep(self._display_time)
+        try:
+            if not self._polling:
+                for queue, directory, cache in self._watched_directories():
+                    self._start_watching(queue, directory, cache)
+            await self.load_media()
+            while True:
+                if self._polling:
+                    self.update_media()
+                self._since_commercial += 1
+                if self._commercial_directory and self._since_commercial >= self._commercial_rate:
+                    self._since_commercial = 0
+                    self._cancel_display()
+                    await meme_display.display_commercial(self.commercial_queue.next_media())
+                if self._commercial_requested.is_set():
+                    self._commercial_requested.clear()
+                    self._since_commercial = 0
+                    self._cancel_display()
+                    await meme_display.display_commercial(self.commercial_queue.next_media())
+                else:
+                    meme = self.meme_queue.next_media()
+                    self._cancel_display()
+                    self._active_display = asyncio.create_task(meme_display.display_meme(meme))
+                    self._active_display.add_done_callback(self._display_done)
+                try:
+                    await asyncio.wait_for(self._commercial_requested.wait(), timeout=self._display_time)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._cancel_display()
+            for task in self._watch_tasks:
+                task.cancel()
 
 
 class MemeServer:
     
-    def __init__(self, meme_watcher: MemeWatcher):
+    def __init__(self, meme_watcher: MemeWatcher, accel_redirect: Optional[str] = None):
         self._meme_watcher = meme_watcher
+        self._directory = meme_watcher.directory
+        self._accel_redirect = accel_redirect
         self._app = web.Application()
-        self._jinja = aiohttp_jinja2.setup(
-            self._app, loader=jinja2.FileSystemLoader(str(Path("templates").absolute()))
+        self._jinja = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(str(Path("templates").absolute())), autoescape=True
         )
+        self._list_template = self._jinja.get_template("list_of_memes.html")
+        self._cached_names: Optional[tuple[str, ...]] = None
+        self._cached_html = b""
 
     async def list_recent_memes(self, request: Request) -> Response:
-        memes = [str(meme.path.name) for meme in self._meme_watcher.meme_queue.get_last_media(10)]
-        return aiohttp_jinja2.render_template(
-            "list_of_memes.html",
-            request,
-            context={
-                "media": memes
-            }
-        )
-    
+        names = tuple(meme.path.name for meme in self._meme_watcher.meme_queue.get_last_media(10))
+        if names != self._cached_names:
+            self._cached_html = self._list_template.render(media=names).encode()
+            self._cached_names = names
+        return Response(body=self._cached_html, content_type='text/html', charset='utf-8')
+
+    def _media_path(self, meme_name: str) -> Path:
+        if not _MEDIA_NAME_RE.fullmatch(meme_name):
+            raise web.HTTPNotFound()
+        meme_path = self._directory / meme_name
+        if meme_path not in self._meme_watcher.meme_queue:
+            raise web.HTTPNotFound()
+        return meme_path
+
     async def report_meme(self, request: Request) -> Response:
-        meme_path = self._meme_watcher.directory / Path(request.match_info['meme_name'])
+        meme_path = self._media_path(request.match_info['meme_name'])
         self._meme_watcher.meme_queue.block_media(meme_path)
         return Response(text="OK!")
 
     async def serve_meme(self, request: Request):
-        meme_path = self._meme_watcher.directory / request.match_info['meme']
-        print(f"Trying to serve: {meme_path}")
+        meme_name = request.match_info['meme']
+        meme_path = self._media_path(meme_name)
+        if self._accel_redirect:
+            return Response(headers={'X-Accel-Redirect': f"{self._accel_redirect.rstrip('/')}/{quote(meme_name)}"})
         return FileResponse(meme_path)
     
     async def kill_commercial(self, request: Request):
@@ -244,7 +471,7 @@ class MemeServer:
             return Response(text=str(meme_path[0].path.name))
 
     async def _cleanup(self, app):
-        self._meme_watcher.meme_queue.dump_bad_media()
+        await self._meme_watcher.meme_queue.dump_bad_media()
 
     async def serve(self, hostname='0.0.0.0', port=8080):
         self._app.add_routes([
@@ -270,7 +497,7 @@ async def main(args):
     )
     await asyncio.gather(
         meme_watcher.watch_memes(),
-        MemeServer(meme_watcher).serve(args.hostname, args.port),
+        MemeServer(meme_watcher, accel_redirect=args.accel_redirect).serve(args.hostname, args.port),
     )
 
 if __name__ == '__main__':
@@ -282,6 +509,7 @@ if __name__ == '__main__':
     parser.add_argument('--commercial-rate', type=int, default=100)
     parser.add_argument('--feh-pid', type=int)
     parser.add_argument('--feh-pic-path', type=Path)
+    parser.add_argument('--accel-redirect', help='nginx internal location serving the meme directory')
     parser.add_argument('directory')
     args = parser.parse_args()
     asyncio.run(main(args))